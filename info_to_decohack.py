@@ -3,19 +3,48 @@
 #
 # Currently supports Doom, Heretic and Hexen. Use chocolate-doom source for info.c files.
 #
-#   python3 info_to_decohack.py <path_to_info> [mobj name]
+#   python3 info_to_decohack.py <path_to_info> [mobj name] [-o output.dh]
 #
 # Run with no mobj name to dump all mobjs
 #
+# As a library, parse_info() returns the states and mobjs tables, and
+# iter_decohack()/iter_things() yield the rendered text or structured form
+# of each mobj in turn.
+#
+# To convert several games' info.c files in parallel, writing <game>.dh for
+# each (named after the info.c file's directory), run:
+#
+#   python3 info_to_decohack.py --batch <output_dir> <path_to_info> ...
+#
+# Pass --cache-dir <dir> to keep parsed and converted info.c files between
+# runs, so unchanged ones are skipped.
+#
 
 from collections import namedtuple
+import argparse
+import contextlib
+import hashlib
+import io
+import multiprocessing
+import os
 import sys
 import re
 
+import pickle_cache
+
 State = namedtuple('State', 'sprite frame tics action nextstate misc1 misc2')
 Property = namedtuple('Property', 'name value')
 MobjInfo = namedtuple('MobjInfo', 'name props')
 
+# Bump when the parsed tables or Decohack output change
+CACHE_VERSION = 1
+
+# Structured Decohack output. Thing props and sounds are (name, value)
+# pairs. A StateBlock's end is its loop/goto/stop line, or None if it
+# falls through into the next label.
+Thing = namedtuple('Thing', 'name props sounds flags states')
+StateBlock = namedtuple('StateBlock', 'label steps end')
+
 state_names = [
     'spawn',
     'see',
@@ -34,17 +63,22 @@ state_names = [
     'raise',
     ]
 
+# info.c state table line
+STATE_LINE = re.compile(
+    r'\s*\{([A-Z]{3}_[A-Z0-9]{4}),\s*'	# Sprite
+    r'([-0-9]+),\s*'				# Frame
+    r'([-0-9]+),\s*'				# Tics
+    r'\{?([A-Za-z0-9_]+)\}?,\s*'		# Action
+    r'([A-Za-z0-9_]+),\s*'			# Next state
+    r'([-0-9]+),\s*'				# Misc 1
+    r'([-0-9]+)\s*\},?\s*'			# Misc 2
+    r'// (.*)$')				# Comment
+
+STATES_START   = re.compile(r'^state_t\s+states')
+MOBJINFO_START = re.compile(r'^mobjinfo_t')
+
 def parse_state_line(line):
-    exp  = r'\s*\{([A-Z]{3}_[A-Z0-9]{4}),\s*'	# Sprite
-    exp += r'([-0-9]+),\s*'			# Frame
-    exp += r'([-0-9]+),\s*'			# Tics
-    exp += r'\{?([A-Za-z0-9_]+)\}?,\s*'		# Action
-    exp += r'([A-Za-z0-9_]+),\s*'		# Next state
-    exp += r'([-0-9]+),\s*'			# Misc 1
-    exp += r'([-0-9]+)\s*\},?\s*'		# Misc 2
-    exp += r'// (.*)$'				# Comment
-
-    m = re.match(exp, line)
+    m = STATE_LINE.match(line)
     if m:
         sprite    = m.group(1)
         frame     = int(m.group(2), 10)
@@ -66,25 +100,6 @@ def parse_state_line(line):
     print(line)
     raise Exception('Bad state')
 
-def parse_states(lines):
-    states = {}
-    done = False
-
-    for i, line in enumerate(lines):
-        if done:
-            break
-
-        if re.search(r'^state_t\s+states', line):
-            for state_line in lines[i + 1:]:
-                if state_line.startswith('};'):
-                    done = True
-                    break
-
-                name, state = parse_state_line(state_line)
-                states[name] = state
-
-    return states
-
 def parse_mobjinfo_property(line):
     tokens = line.split('//')
     if len(tokens) != 2:
@@ -102,28 +117,54 @@ def parse_mobjinfo_property(line):
 
     return Property(prop_name, prop_value)
 
-def parse_mobjinfo(lines):
-    found_start = False
-    mobj = None
+def parse_mobjinfo_start(line):
+    # Find the start of a mobj definition
+    tokens = line.split('//')
+    if len(tokens) != 2:
+        return None
+
+    brace     = tokens[0].strip()
+    mobj_name = tokens[1].strip()
+    if brace != '{' or not mobj_name.startswith('MT_'):
+        return None
+
+    return MobjInfo(mobj_name, {})
+
+def parse_info(lines):
+    #
+    # Single pass over info.c, which can be any iterable of lines such as an
+    # open file. Returns the (states, mobjs) tables.
+    #
+    states = {}
     mobjs = {}
 
-    for line in lines:
-        if not found_start:
-            if line.startswith('mobjinfo_t'):
-                found_start = True
+    table = None
+    done = set()
+    mobj = None
 
-        elif mobj is None:
-            # Find the start of a mobj definition
-            tokens = line.split('//')
-            if len(tokens) != 2:
+    for line in lines:
+        if table is None:
+            if 'states' not in done and STATES_START.search(line):
+                table = 'states'
+            elif 'mobjinfo' not in done and MOBJINFO_START.search(line):
+                table = 'mobjinfo'
+
+        elif table == 'states':
+            if line.startswith('};'):
+                done.add(table)
+                table = None
                 continue
 
-            brace     = tokens[0].strip()
-            mobj_name = tokens[1].strip()
-            if brace != '{' or not mobj_name.startswith('MT_'):
+            name, state = parse_state_line(line)
+            states[name] = state
+
+        elif mobj is None:
+            if line.startswith('};'):
+                done.add(table)
+                table = None
                 continue
 
-            mobj = MobjInfo(mobj_name, {})
+            mobj = parse_mobjinfo_start(line)
 
         else:
             # Parsing mobj properties
@@ -137,7 +178,13 @@ def parse_mobjinfo(lines):
                 if prop:
                     mobj.props[prop.name] = prop.value
 
-    return mobjs
+    return states, mobjs
+
+def parse_states(lines):
+    return parse_info(lines)[0]
+
+def parse_mobjinfo(lines):
+    return parse_info(lines)[1]
 
 def state_to_decohack(state):
     return merged_state_to_decohack([state])
@@ -196,58 +243,70 @@ def merge_states(states):
 
     return new_states
 
-def get_first_state(mobj, state_name):
-    prop_name = '{}state'.format(state_name)
-    if prop_name in mobj.props:
-        try:
-            return states[mobj.props[prop_name]]
-        except:
-            pass
-
-    return None
-
-def build_state_machine(mobj, state_name, states):
+class StateLabels:
+    #
+    # A mobj's state labels. Maps each label to the name of its first state,
+    # and each first state name back to its label so that jumps can be
+    # resolved without searching. Where labels share a first state the
+    # earliest one in state_names wins, as with combined melee/missile.
+    #
+    def __init__(self, mobj, states):
+        self.first = {}
+        self.entries = {}
+
+        for state_name in state_names:
+            name = mobj.props.get('{}state'.format(state_name))
+            if name in states:
+                self.add(state_name, name)
+
+    def add(self, label, name):
+        self.first[label] = name
+
+        if label in state_names:
+            other = self.entries.get(name)
+            if other is None or state_names.index(label) < state_names.index(other):
+                self.entries[name] = label
+
+def build_state_machine(labels, state_name, states):
     goto = None
 
     items = []
+    visited = {}
 
-    state = get_first_state(mobj, state_name)
+    name = labels.first.get(state_name)
 
-    while state is not None:
+    while name is not None:
+        state = states[name]
+        visited[name] = len(items)
         items.append(state)
-        try:
-            next_state = states[state.nextstate]
-        except:
-            next_state = None
+
+        next_name = state.nextstate
+        if next_name not in states:
+            break
 
         # Has this state looped/jumped to the start of another state
-        if next_state is not None:
-            for other_state_name in state_names:
-                if next_state == get_first_state(mobj, other_state_name):
-                    goto = other_state_name
-                    next_state = None
-                    break
+        if next_name in labels.entries:
+            goto = labels.entries[next_name]
+            break
 
         # Check for loop back to non-starting state
-        if next_state is not None and len(items) > 1:
-            for i, other_state in enumerate(items[1:]):
-                if next_state == other_state:
-                    # Create a new state
-                    if state_name == 'missile':
-                        new_state_name = 'refire'
-                    elif state_name == 'see':
-                        new_state_name = 'run'
-                    else:
-                        new_state_name = '{}_2'.format(state_name)
-
-                    items = items[0:i + 1]
-                    mobj.props['{}state'.format(new_state_name)] = state.nextstate
-
-                    goto = 'continue'
-                    next_state = None
-                    break
-
-        state = next_state
+        pos = visited.get(next_name)
+        if pos:
+            # Create a new state
+            if state_name == 'missile':
+                new_state_name = 'refire'
+            elif state_name == 'see':
+                new_state_name = 'run'
+            else:
+                new_state_name = '{}_2'.format(state_name)
+
+            items = items[0:pos]
+            labels.add(new_state_name, next_name)
+
+            goto = 'continue'
+            break
+
+        name = next_name
 
     return items, goto
 
@@ -321,88 +380,240 @@ def mobj_flags(mobj):
 
     return flags
 
-def mobj_to_decohack(mobj, states):
-    lines = []
+def state_block_end(state_name, goto):
+    if goto is None:
+        return 'stop'
+
+    if goto == 'continue':
+        return None
+
+    if goto == state_name and state_name != 'refire' and state_name != 'run':
+        return 'loop'
+
+    return 'goto {}'.format(goto)
+
+def mobj_to_thing(mobj, states):
+    #
+    # Returns the structured Decohack form of a mobj. Neither mobj nor states
+    # are modified.
+    #
+    labels = StateLabels(mobj, states)
+    blocks = []
+
+    for state_name in state_names:
+        items, goto = build_state_machine(labels, state_name, states)
+        if len(items) == 0:
+            continue
+
+        # Many mobjs have combined melee/missile states
+        if state_name == 'melee' and labels.first['melee'] == labels.first.get('missile'):
+            blocks.append(StateBlock(state_name, [], None))
+            continue
+
+        steps = [merged_state_to_decohack(m) for m in merge_states(items)]
+        blocks.append(StateBlock(state_name, steps, state_block_end(state_name, goto)))
 
-    print('thing {}'.format(mobj.name))
-    print('{')
+    return Thing(mobj.name, mobj_props(mobj), mobj_sounds(mobj), mobj_flags(mobj), blocks)
+
+def thing_to_decohack(thing, out):
+    #
+    # Appends the Decohack lines for a thing, without line endings, to out.
+    #
+    out.append('thing {}'.format(thing.name))
+    out.append('{')
 
     # Properties
-    nl = False
-    for k, v in mobj_props(mobj):
-        print('\t{}{}{}'.format(k, '\t' if len(k) >= 8 else '\t\t', v))
-        nl = True
-    if nl:
-        print('')
+    for k, v in thing.props:
+        out.append('\t{}{}{}'.format(k, '\t' if len(k) >= 8 else '\t\t', v))
+    if thing.props:
+        out.append('')
 
     # Sounds
-    nl = False
-    for k, v in mobj_sounds(mobj):
-        print('\t{}\t{}'.format(k, v))
-        nl = True
-    if nl:
-        print('')
+    for k, v in thing.sounds:
+        out.append('\t{}\t{}'.format(k, v))
+    if thing.sounds:
+        out.append('')
 
     # Flags
-    nl = False
-    print('\tclear flags')
-    for flag in mobj_flags(mobj):
-        print('\t+{}'.format(flag))
-        nl = True
-    if nl:
-        print('')
+    out.append('\tclear flags')
+    for flag in thing.flags:
+        out.append('\t+{}'.format(flag))
+    if thing.flags:
+        out.append('')
 
     # States
-    print('\tstates')
-    print('\t{')
+    out.append('\tstates')
+    out.append('\t{')
+
+    for block in thing.states:
+        out.append('\t\t{}:'.format(block.label))
+        for step in block.steps:
+            out.append('\t\t\t{}'.format(step))
+        if block.end is not None:
+            out.append('\t\t\t{}'.format(block.end))
+
+    out.append('\t}')
+    out.append('}')
+
+    return out
+
+def mobj_to_decohack(mobj, states, out):
+    #
+    # Appends the Decohack lines for a mobj, without line endings, to out.
+    #
+    return thing_to_decohack(mobj_to_thing(mobj, states), out)
+
+def iter_things(mobjs, states):
+    #
+    # Yields the structured Decohack form of each of mobjs
+    #
+    for mobj in mobjs:
+        yield mobj_to_thing(mobj, states)
+
+def iter_decohack(mobjs, states):
+    #
+    # Yields the rendered Decohack text of each of mobjs, one thing block
+    # at a time.
+    #
+    for thing in iter_things(mobjs, states):
+        yield '\n'.join(thing_to_decohack(thing, [])) + '\n'
+
+def write_decohack(fd, mobjs, states):
+    #
+    # Writes the Decohack for each of mobjs, separated by blank lines, to the
+    # text stream fd in a single write.
+    #
+    fd.write(''.join(block + '\n' for block in iter_decohack(mobjs, states)))
+
+def cache_filename(cache_dir, fd):
+    # The cache is keyed on a hash of the info.c contents, read from fd in chunks
+    key = hashlib.blake2b(digest_size=16)
+    key.update('{}\n'.format(CACHE_VERSION).encode())
+    for chunk in iter(lambda: fd.read(1 << 16), b''):
+        key.update(chunk)
+
+    return os.path.join(cache_dir, '{}.cache'.format(key.hexdigest()))
+
+def load_cache(cache_file):
+    try:
+        states, mobjs, text = pickle_cache.load(cache_file)
+    except (TypeError, ValueError):
+        return None
 
-    for state_name in state_names:
-        state_steps = []
-        state_loop  = False
+    states = {name: State(*state) for name, state in states.items()}
+    mobjs = {name: MobjInfo(name, props) for name, props in mobjs.items()}
 
-        items, goto = build_state_machine(mobj, state_name, states)
-        if len(items) == 0:
-            continue
+    return states, mobjs, text
 
-        prev_item = None
+def save_cache(cache_file, states, mobjs, text):
+    # States are stored as tuples and mobjs as their props dicts
+    cached = ({name: tuple(state) for name, state in states.items()},
+              {name: mobj.props for name, mobj in mobjs.items()},
+              text)
 
-        print('\t\t{}:'.format(state_name))
+    pickle_cache.save(cache_file, cached)
 
-        # Many mobjs have combined melee/missile states
-        if state_name == 'melee' and get_first_state(mobj, 'melee') == get_first_state(mobj, 'missile'):
-            continue
+def load_info(filename, cache_dir=None):
+    #
+    # Returns the (states, mobjs, text) for an info.c file, where text is the
+    # Decohack for all of its mobjs. With a cache_dir the results are kept on
+    # disk, so an unchanged info.c is neither parsed nor rendered again.
+    #
+    with open(filename, 'rb') as fd:
+        cache_file = None
+        if cache_dir:
+            cache_file = cache_filename(cache_dir, fd)
+            cached = load_cache(cache_file)
+            if cached:
+                return cached
 
-        for m in merge_states(items):
-            print('\t\t\t{}'.format(merged_state_to_decohack(m)))
-
-        if goto is not None:
-            if goto == state_name:
-                if state_name == 'refire' or state_name == 'run':
-                    print('\t\t\tgoto {}'.format(goto))
-                else:
-                    print('\t\t\tloop')
-            elif goto == 'continue':
-                pass
-            else:
-                print('\t\t\tgoto {}'.format(goto))
-        else:
-            print('\t\t\tstop')
+            fd.seek(0)
+
+        states, mobjs = parse_info(io.TextIOWrapper(fd))
 
+    text = ''.join(block + '\n' for block in iter_decohack(mobjs.values(), states))
 
-    print('\t}')
-    print('}')
+    if cache_file:
+        save_cache(cache_file, states, mobjs, text)
+
+    return states, mobjs, text
+
+def decohack_filename(info_filename):
+    # Chocolate-doom keeps each game's info.c in its own directory, name the output after that
+    name = os.path.splitext(os.path.basename(info_filename))[0]
+    if name == 'info':
+        name = os.path.basename(os.path.dirname(os.path.abspath(info_filename)))
+
+    return '{}.dh'.format(name)
+
+def batch_convert_info(job):
+    info_filename, output_filename, cache_dir = job
+
+    try:
+        _, _, text = load_info(info_filename, cache_dir)
+        with open(output_filename, 'w') as fd:
+            fd.write(text)
+    except Exception as e:
+        return (info_filename, False, '{}: {}'.format(type(e).__name__, e))
+
+    return (info_filename, True, output_filename)
+
+def convert_batch(info_filenames, output_dir, jobs=None, cache_dir=None):
+    #
+    # Convert each info.c to <output_dir>/<game>.dh on a process pool.
+    # Returns a list of (info filename, success, output filename or error)
+    # tuples.
+    #
+    os.makedirs(output_dir, exist_ok=True)
+
+    jobs_list = []
+    outputs = set()
+    for info_filename in info_filenames:
+        output_filename = os.path.join(output_dir, decohack_filename(info_filename))
+        if output_filename in outputs:
+            raise ValueError('Multiple inputs would be written to {}'.format(output_filename))
+
+        outputs.add(output_filename)
+        jobs_list.append((info_filename, output_filename, cache_dir))
+
+    with multiprocessing.Pool(jobs) as pool:
+        return pool.map(batch_convert_info, jobs_list, chunksize=1)
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Dump info.c out as Decohack')
+    parser.add_argument('files', nargs='+', metavar='file',
+                        help='<info.c> [mobj name], or with --batch the info.c files')
+    parser.add_argument('-o', '--output', help='Write to this file instead of stdout')
+    parser.add_argument('--batch', metavar='OUTPUT_DIR',
+                        help='Convert many info.c files in parallel, writing <game>.dh files to OUTPUT_DIR')
+    parser.add_argument('-j', '--jobs', type=int, help='Number of worker processes for --batch')
+    parser.add_argument('--cache-dir', help='Directory for caching parsed and converted info.c files between runs')
+    args = parser.parse_args()
+
+    if args.batch:
+        try:
+            results = convert_batch(args.files, args.batch, args.jobs, args.cache_dir)
+        except ValueError as e:
+            parser.error(str(e))
+
+        failed = len([result for result in results if not result[1]])
+        for info_filename, ok, detail in results:
+            if ok:
+                print('OK {} -> {}'.format(info_filename, detail))
+            else:
+                print('FAILED {}: {}'.format(info_filename, detail))
 
-    lines = open(sys.argv[1], 'r').readlines()
+        sys.exit(1 if failed else 0)
 
-    states = parse_states(lines)
-    mobjs  = parse_mobjinfo(lines)
+    if len(args.files) > 2:
+        parser.error('expected <info.c> [mobj name]')
 
-    if len(sys.argv) > 2:
-        mobj = mobjs[sys.argv[2]]
-        mobj_to_decohack(mobj, states)
-    else:
-        for mobj in mobjs.values():
-            mobj_to_decohack(mobj, states)
-            print('')
+    with open(args.output, 'w') if args.output else contextlib.nullcontext(sys.stdout) as fd:
+        if len(args.files) == 2:
+            with open(args.files[0], 'r') as info_fd:
+                states, mobjs = parse_info(info_fd)
+
+            fd.write(next(iter_decohack([mobjs[args.files[1]]], states)))
+        else:
+            _, _, text = load_info(args.files[0], args.cache_dir)
+            fd.write(text)
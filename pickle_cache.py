@@ -0,0 +1,33 @@
+#
+# On-disk pickle caches shared by wad_strip.py and info_to_decohack.py.
+#
+# Callers should store plain tuples, lists and dicts rather than their own
+# classes, so a cache can be read back whichever module name (or __main__)
+# the script was run as.
+#
+import os
+import pickle
+import sys
+
+def load(cache_file):
+    # Returns the cached object, or None if it is missing or unreadable
+    try:
+        with open(cache_file, 'rb') as fd:
+            return pickle.load(fd)
+    except Exception:
+        return None
+
+def save(cache_file, obj):
+    #
+    # Write via a per-process temporary file and rename it into place, so
+    # concurrent runs never read a partially written cache. A cache that
+    # can't be written is reported but isn't an error.
+    #
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = '{}.{}.tmp'.format(cache_file, os.getpid())
+        with open(tmp_file, 'wb') as fd:
+            pickle.dump(obj, fd, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except OSError as e:
+        print('Unable to write cache {}: {}'.format(cache_file, e), file=sys.stderr)
@@ -0,0 +1,146 @@
+#
+# Benchmark for wad_strip.py. Generates synthetic wads with wad_synth.py at
+# increasing scales, strips each one and times the individual phases.
+#
+#   python3 wad_bench.py [--scales 1,2,4,8] [--repeat N] [--json] [--max-exponent X]
+#
+# For each phase the scaling exponent between the two largest scales is
+# reported: ~1 is linear, ~2 is quadratic. With --max-exponent the script
+# exits non-zero if any phase scales worse than that, for use in CI.
+#
+from collections import OrderedDict
+import argparse
+import json
+import math
+import os
+import sys
+import tempfile
+import time
+
+import wad_strip
+import wad_synth
+
+# wad_strip.Stats phases to report. Phase times are inclusive, so write
+# includes build_textures_lump.
+PHASES = [
+    'parse_lump_table',
+    'load_patches',
+    'load_textures',
+    'load_flats',
+    'find_used_textures',
+    'mark_used_animations',
+    'build_textures_lump',
+    'write',
+    ]
+
+# Phases faster than this at the largest scale are too noisy to judge
+MIN_PHASE_TIME = 0.002
+
+def scaled_params(base, scale):
+    return base._replace(sidedefs=base.sidedefs * scale,
+                         sectors=base.sectors * scale,
+                         textures=base.textures * scale,
+                         patches=base.patches * scale,
+                         flats=base.flats * scale,
+                         animations=base.animations * scale,
+                         switches=base.switches * scale)
+
+def run_strip(iwad_filename, pwad_filename, output_filename):
+    stats = wad_strip.Stats()
+
+    start = time.perf_counter()
+    iwad = wad_strip.Wad(iwad_filename, use_mmap=True, stats=stats)
+    wad_strip.strip_pwad(iwad, pwad_filename, output_filename, stats)
+    total = time.perf_counter() - start
+    iwad.close()
+
+    timings = OrderedDict((name, stats.get_phase(name)['time']) for name in PHASES)
+    timings['total'] = total
+
+    return timings
+
+def run_scale(tmpdir, params, repeat):
+    iwad_filename = os.path.join(tmpdir, 'iwad.wad')
+    pwad_filename = os.path.join(tmpdir, 'pwad.wad')
+    output_filename = os.path.join(tmpdir, 'output.wad')
+
+    wad_synth.write_pair(iwad_filename, pwad_filename, params)
+
+    # Take the best of several runs for each phase
+    best = None
+    for _ in range(repeat):
+        timings = run_strip(iwad_filename, pwad_filename, output_filename)
+        if best is None:
+            best = timings
+        else:
+            for name in best:
+                best[name] = min(best[name], timings[name])
+
+    return best
+
+def scaling_exponents(scales, results):
+    exponents = OrderedDict()
+    if len(scales) < 2:
+        return exponents
+
+    s1, s2 = scales[-2], scales[-1]
+    t1, t2 = results[-2], results[-1]
+    for name in t2:
+        if t2[name] < MIN_PHASE_TIME or t1[name] <= 0:
+            exponents[name] = None
+        else:
+            exponents[name] = math.log(t2[name] / t1[name]) / math.log(s2 / s1)
+
+    return exponents
+
+def print_report(scales, results, exponents):
+    names = list(results[0].keys())
+    width = max(len(name) for name in names)
+
+    print('{}  {}  {}'.format('phase'.ljust(width),
+                              ''.join('{:>10}'.format('x{}'.format(s)) for s in scales),
+                              'exponent'))
+
+    for name in names:
+        times = ''.join('{:>10.4f}'.format(result[name]) for result in results)
+        exponent = exponents.get(name)
+        exponent = '{:8.2f}'.format(exponent) if exponent is not None else '       -'
+        print('{}  {}  {}'.format(name.ljust(width), times, exponent))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark wad_strip on synthetic wads')
+    parser.add_argument('--scales', default='1,2,4,8', help='Comma separated scale factors')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per scale, the best time is kept')
+    parser.add_argument('--json', action='store_true', help='Print the results as JSON')
+    parser.add_argument('--max-exponent', type=float, help='Fail if any phase scales worse than this')
+    for field, default in wad_synth.SynthParams._field_defaults.items():
+        parser.add_argument('--{}'.format(field), type=int, default=default,
+                            help='Base value, multiplied by each scale' if field not in ('maps', 'seed') else None)
+    args = parser.parse_args()
+
+    base = wad_synth.SynthParams(**{field: getattr(args, field) for field in wad_synth.SynthParams._fields})
+    scales = [int(s) for s in args.scales.split(',')]
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for scale in scales:
+            results.append(run_scale(tmpdir, scaled_params(base, scale), args.repeat))
+
+    exponents = scaling_exponents(scales, results)
+
+    if args.json:
+        print(json.dumps({
+            'params': base._asdict(),
+            'scales': scales,
+            'timings': results,
+            'exponents': exponents,
+            }, indent=2))
+    else:
+        print_report(scales, results, exponents)
+
+    if args.max_exponent is not None:
+        slow = [name for name, exponent in exponents.items()
+                if exponent is not None and exponent > args.max_exponent]
+        if slow:
+            print('Phases scaling worse than {}: {}'.format(args.max_exponent, ', '.join(slow)), file=sys.stderr)
+            sys.exit(1)
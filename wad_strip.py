@@ -4,60 +4,547 @@
 #
 #   python3 wad_strip.py <iwad.wad> <pwad.wad> <output.wad>
 #
-from collections import namedtuple
+# To strip many pwads against the same iwad in parallel run:
+#
+#   python3 wad_strip.py --batch <output_dir> <iwad.wad> <pwad.wad|dir> ...
+#
+# To report what would be removed from each pwad, as one JSON object per
+# line, without writing anything run:
+#
+#   python3 wad_strip.py --report <iwad.wad> <pwad.wad|dir> ...
+#
+# Pass --cache-dir <dir> to cache the parsed iwad between runs, and --stats
+# to print per-phase timings and counters as JSON. With --incremental a
+# <output.wad>.manifest is kept so that later runs only rescan changed maps.
+#
+from array import array
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from functools import cached_property
+from itertools import chain
+import argparse
+import contextlib
+import functools
+import hashlib
+import json
+import mmap
+import multiprocessing
+import os
+import re
 import struct
 import sys
+import threading
+import time
+
+import pickle_cache
 
 Lump = namedtuple('Lump', 'name offset size')
 Texture = namedtuple('Texture', 'name masked width height columndir patches')
 MapPatch = namedtuple('MapPatch', 'name x y stepdir colormap')
 
+# Bump when the layout or contents of the parsed wad cache change
+CACHE_VERSION = 3
+
+# Lumps read when analysing a wad, which are worth prefetching
+ANALYSIS_LUMPS = ['PNAMES', 'TEXTURE1', 'ANIMATED', 'SWITCHES', 'UMAPINFO', 'SIDEDEFS', 'SECTORS', 'TEXTMAP']
+
+# Gap between lumps below which prefetch ranges are merged
+PREFETCH_MERGE_GAP = 64 * 1024
+
+# Bump when the layout of the incremental strip manifest changes
+MANIFEST_VERSION = 2
+
 def sanitize_lump_name(name):
     name = name.split(b'\x00')[0]
     return name.decode('ascii').upper()
 
+#
+# Tokenizer for the parts of a UDMF TEXTMAP that name textures and flats.
+# Comments and other string values are matched as whole tokens so that
+# anything inside them is skipped.
+#
+UDMF_TOKENS = re.compile(rb'''
+      //[^\n]*
+    | /\*.*?\*/
+    | \b(?P<key>texture(?:top|middle|bottom|floor|ceiling))\s*=\s*"(?P<value>[^"]*)"
+    | "(?:[^"\\]|\\.)*"
+    ''', re.VERBOSE | re.DOTALL | re.IGNORECASE)
+
+UDMF_FLAT_KEYS = (b'texturefloor', b'textureceiling')
+
+#
+# Map lump scanners. Each returns a dict of the sorted 'textures' and/or
+# 'flats' names used by the lump.
+#
+def scan_sidedefs(data):
+    raw_names = set(chain.from_iterable(struct.iter_unpack('<4x8s8s8s2x', data)))
+    textures = set(sanitize_lump_name(name) for name in raw_names)
+    textures.discard('-')
+
+    return {'textures': sorted(textures)}
+
+def scan_sectors(data):
+    raw_names = set(chain.from_iterable(struct.iter_unpack('<4x8s8s6x', data)))
+    return {'flats': sorted(set(sanitize_lump_name(name) for name in raw_names))}
+
+def scan_textmap(data):
+    # Single pass over the TEXTMAP, without splitting it into lines or copying it
+    raw_textures = set()
+    raw_flats = set()
+    for m in UDMF_TOKENS.finditer(data):
+        key = m.group('key')
+        if key is None:
+            continue
+
+        if key.lower() in UDMF_FLAT_KEYS:
+            raw_flats.add(m.group('value'))
+        else:
+            raw_textures.add(m.group('value'))
+
+    textures = set(name.decode('ascii', errors='ignore').upper() for name in raw_textures)
+    textures.discard('-')
+    flats = set(name.decode('ascii', errors='ignore').upper() for name in raw_flats)
+
+    return {'textures': sorted(textures), 'flats': sorted(flats)}
+
+def first_positions(names):
+    positions = {}
+    for i, name in enumerate(names):
+        positions.setdefault(name, i)
+
+    return positions
+
+def animation_range(names, positions, name_first, name_last):
+    #
+    # Animation frames run from the first occurrence of name_first up to
+    # the first occurrence of name_last. If name_last comes first then the
+    # animation is empty.
+    #
+    first = positions.get(name_first)
+    if first is None:
+        return []
+
+    last = positions.get(name_last, len(names) - 1)
+    return names[first:last + 1]
+
+def build_animation_index(animations):
+    # Map each name to the indices of the animation groups containing it
+    index = {}
+    for group, animation in enumerate(animations):
+        for name in animation:
+            groups = index.setdefault(name, [])
+            if not groups or groups[-1] != group:
+                groups.append(group)
+
+    return index
+
+class Stats(object):
+    #
+    # Per-phase instrumentation. Each phase records its call count and
+    # inclusive wall time. Counters (bytes read, lumps scanned, lookups,
+    # ...) are added to the innermost running phase, or to 'other' outside
+    # of any phase. An optional hook is called with the phase name and must
+    # return a context manager, which is entered around the phase, e.g. to
+    # drive an external profiler. Phases may run on several threads, each
+    # thread tracks its own innermost phase.
+    #
+    def __init__(self, hook=None):
+        self.hook = hook
+        self.phases = OrderedDict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    @property
+    def active(self):
+        if not hasattr(self.local, 'active'):
+            self.local.active = []
+
+        return self.local.active
+
+    def get_phase(self, name):
+        with self.lock:
+            if name not in self.phases:
+                self.phases[name] = OrderedDict([('calls', 0), ('time', 0.0)])
+
+            return self.phases[name]
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        entry = self.get_phase(name)
+        with self.lock:
+            entry['calls'] += 1
+
+        hook = self.hook(name) if self.hook else contextlib.nullcontext()
+        active = self.active
+        active.append(name)
+        start = time.perf_counter()
+        try:
+            with hook:
+                yield
+        finally:
+            with self.lock:
+                entry['time'] += time.perf_counter() - start
+            active.pop()
+
+    def count(self, counter, n=1):
+        active = self.active
+        entry = self.get_phase(active[-1] if active else 'other')
+        with self.lock:
+            entry[counter] = entry.get(counter, 0) + n
+
+    def to_dict(self):
+        totals = OrderedDict()
+        for entry in self.phases.values():
+            for counter, value in entry.items():
+                if counter not in ('calls', 'time'):
+                    totals[counter] = totals.get(counter, 0) + value
+
+        return OrderedDict([('phases', self.phases), ('totals', totals)])
+
+def phase(name):
+    # Method decorator which runs the method as a phase of self.stats
+    def decorate(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            with self.stats.phase(name):
+                return method(self, *args, **kwargs)
+
+        return wrapper
+
+    return decorate
+
+def unpack_array(typecode, data):
+    values = array(typecode)
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+
+    return values
+
+class TextureTable(object):
+    #
+    # Columnar storage for a TEXTUREx lump. Each texture's header fields are
+    # held in parallel arrays, and its patch placements are the rows
+    # patch_start[i]:patch_start[i + 1] of the placement arrays. Placements
+    # refer to patches by their PNAMES index, so each patch name is stored
+    # once. Indexing or iterating the table gives Texture/MapPatch views.
+    #
+    columns = ['masked', 'width', 'height', 'columndir', 'patch_start',
+               'patch_x', 'patch_y', 'patch_index', 'patch_stepdir', 'patch_colormap']
+
+    def __init__(self, pnames):
+        self.pnames = pnames
+        self.names = []
+
+        self.masked = array('I')
+        self.width = array('H')
+        self.height = array('H')
+        self.columndir = array('I')
+
+        self.patch_start = array('I', [0])
+        self.patch_x = array('H')
+        self.patch_y = array('H')
+        self.patch_index = array('H')
+        self.patch_stepdir = array('H')
+        self.patch_colormap = array('H')
+
+    @classmethod
+    def from_lump(cls, pnames, lump):
+        table = cls(pnames)
+
+        num_textures = struct.unpack_from('<I', lump, 0)[0]
+        texture_offsets = struct.unpack_from('<{}I'.format(num_textures), lump, 4)
+
+        # Gather the raw 10 byte placement records and split them into columns
+        placements = bytearray()
+        for offset in texture_offsets:
+            name, masked, width, height, columndir, num_patches = struct.unpack_from('<8sIHHIH', lump, offset)
+            offset += 22
+
+            table.names.append(sanitize_lump_name(name))
+            table.masked.append(masked)
+            table.width.append(width)
+            table.height.append(height)
+            table.columndir.append(columndir)
+
+            placements += lump[offset:offset + (10 * num_patches)]
+            table.patch_start.append(len(placements) // 10)
+
+        rows = unpack_array('H', placements)
+        table.patch_x = rows[0::5]
+        table.patch_y = rows[1::5]
+        table.patch_index = rows[2::5]
+        table.patch_stepdir = rows[3::5]
+        table.patch_colormap = rows[4::5]
+
+        if table.patch_index and max(table.patch_index) >= len(pnames):
+            raise IndexError('Texture patch index out of range in PNAMES')
+
+        return table
+
+    @classmethod
+    def from_state(cls, pnames, state):
+        table = cls(pnames)
+        table.names = list(state[0])
+        for column, values in zip(cls.columns, state[1:]):
+            setattr(table, column, values)
+
+        return table
+
+    def to_state(self):
+        return (tuple(self.names),) + tuple(getattr(self, column) for column in self.columns)
+
+    def __len__(self):
+        return len(self.names)
+
+    def check_index(self, i):
+        # Normalise a list style index, so the view behaves like a list of Texture
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('texture index out of range')
+
+        return i
+
+    def __getitem__(self, i):
+        i = self.check_index(i)
+        return Texture(self.names[i], self.masked[i], self.width[i], self.height[i],
+                       self.columndir[i], self.map_patches(i))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def patch_rows(self, i):
+        i = self.check_index(i)
+        return range(self.patch_start[i], self.patch_start[i + 1])
+
+    def patch_names(self, i):
+        return [self.pnames[self.patch_index[j]] for j in self.patch_rows(i)]
+
+    def map_patches(self, i):
+        return [MapPatch(self.pnames[self.patch_index[j]], self.patch_x[j], self.patch_y[j],
+                         self.patch_stepdir[j], self.patch_colormap[j])
+                for j in self.patch_rows(i)]
+
+    def key(self, i):
+        # Hashable form of texture i, for comparing entries by value
+        return ((self.names[i], self.masked[i], self.width[i], self.height[i], self.columndir[i]) +
+                tuple(self.map_patches(i)))
+
 class Wad(object):
-    def __init__(self, filename):
+    def __init__(self, filename, use_mmap=False, cache_dir=None, stats=None):
+        self.filename = filename
+        self.stats = stats if stats is not None else Stats()
         self.fd = open(filename, 'rb')
+
+        #
+        # In mmap mode lump data is returned as memoryview slices of the
+        # mapped file rather than copied out with read().
+        #
+        self.mmap = None
+        self.view = None
+        if use_mmap:
+            self.mmap = mmap.mmap(self.fd.fileno(), 0, access=mmap.ACCESS_READ)
+            self.view = memoryview(self.mmap)
+
         self.lumps = self.parse_lump_table()
+        self.build_lump_index()
+        self.lump_digests = {}
+        self.cached_used_flats = None
+        self.from_cache = False
+
+        # Map lump scan results for this run, and keyed on lump digest when
+        # stripping incrementally
+        self.scan_results = {}
+        self.map_scans = None
+
+        if cache_dir is not None:
+            cache_file = self.cache_filename(cache_dir)
+            if not self.load_cache(cache_file):
+                self.save_cache(cache_file)
+
+    #
+    # The patch, texture and flat tables are only parsed when first used, so
+    # callers which just need the directory or a single lump don't pay for
+    # them.
+    #
+    @cached_property
+    def patches(self):
+        return self.load_patches()
+
+    @cached_property
+    def textures(self):
+        return self.load_textures()
+
+    @cached_property
+    def flats(self):
+        return self.load_flats()
+
+    def load_tables(self):
+        # Parse the lazily loaded tables now rather than on first use
+        self.patches
+        self.textures
+        self.flats
+
+    @phase('prefetch')
+    def prefetch(self, lump_names):
+        #
+        # Hint to the kernel that the named lumps will be read soon, so that
+        # reads are issued ahead of the analysis rather than one at a time.
+        # Neighbouring lumps are merged into larger ranges.
+        #
+        ranges = []
+        lumps = sorted(chain.from_iterable(self.get_all_lumps(name) for name in lump_names),
+                       key=lambda lump: lump.offset)
+        for lump in lumps:
+            if lump.size == 0:
+                continue
 
-        self.patches = self.load_patches()
-        self.textures = self.load_textures()
-        self.flats = self.load_flats()
+            if ranges and lump.offset - ranges[-1][1] <= PREFETCH_MERGE_GAP:
+                ranges[-1][1] = max(ranges[-1][1], lump.offset + lump.size)
+            else:
+                ranges.append([lump.offset, lump.offset + lump.size])
+
+        for start, end in ranges:
+            self.stats.count('bytes_prefetched', end - start)
+            if hasattr(os, 'posix_fadvise'):
+                os.posix_fadvise(self.fd.fileno(), start, end - start, os.POSIX_FADV_WILLNEED)
+            elif self.mmap is not None and hasattr(mmap, 'MADV_WILLNEED'):
+                aligned = start - (start % mmap.PAGESIZE)
+                self.mmap.madvise(mmap.MADV_WILLNEED, aligned, end - aligned)
+
+    def close(self):
+        if self.view is not None:
+            self.view.release()
+            self.view = None
+
+            # Outstanding lump views keep the mapping alive until collected
+            try:
+                self.mmap.close()
+            except BufferError:
+                pass
+
+        self.fd.close()
+
+    def cache_filename(self, cache_dir):
+        #
+        # The cache is keyed on the wad's path, size and mtime, plus a hash
+        # of its header and lump table.
+        #
+        st = os.stat(self.filename)
+        key = hashlib.blake2b(digest_size=16)
+        key.update(os.path.abspath(self.filename).encode())
+        key.update(struct.pack('<IQQ', CACHE_VERSION, st.st_size, st.st_mtime_ns))
+        key.update(self.directory_digest)
+
+        return os.path.join(cache_dir, '{}.cache'.format(key.hexdigest()))
+
+    @phase('load_cache')
+    def load_cache(self, cache_file):
+        try:
+            patches, textures, flats, used_flats = pickle_cache.load(cache_file)
+        except (TypeError, ValueError):
+            return False
+
+        self.patches = list(patches)
+        self.textures = TextureTable.from_state(self.patches, textures)
+        self.flats = list(flats)
+        self.cached_used_flats = list(used_flats)
+        self.from_cache = True
+
+        return True
+
+    @phase('save_cache')
+    def save_cache(self, cache_file):
+        # The texture table is stored as its column arrays
+        state = (tuple(self.patches),
+                 self.textures.to_state(),
+                 tuple(self.flats),
+                 tuple(self.find_used_flats()))
+
+        pickle_cache.save(cache_file, state)
 
+    @phase('parse_lump_table')
     def parse_lump_table(self):
         self.fd.seek(0)
         header = self.fd.read(12)
         wad_type, num_lumps, table_offset = struct.unpack('<4sII', header)
 
-        lumps = []
         self.fd.seek(table_offset)
-        for lump_index in range(num_lumps):
-            lump_header = self.fd.read(16)
-            lump_offset, lump_size, lump_name = struct.unpack('<II8s', lump_header)
-            lumps.append(Lump(sanitize_lump_name(lump_name), lump_offset, lump_size))
+        table = self.fd.read(16 * num_lumps)
+        self.stats.count('bytes_read', len(header) + len(table))
+        self.directory_digest = hashlib.blake2b(header + table, digest_size=16).digest()
+        entries = list(struct.iter_unpack('<II8s', table))
 
-        return lumps
+        # Lump names repeat heavily (map lumps, markers), decode each once
+        names = {raw: sanitize_lump_name(raw) for raw in set(entry[2] for entry in entries)}
+
+        return [Lump(names[lump_name], lump_offset, lump_size)
+                for lump_offset, lump_size, lump_name in entries]
+
+    def build_lump_index(self):
+        #
+        # Map each lump name to its positions in the lump table, in table
+        # order, so that lookups keep the "first match wins" behaviour.
+        #
+        self.lump_index = {}
+        for i, lump in enumerate(self.lumps):
+            self.lump_index.setdefault(lump.name, []).append(i)
+
+        self.marker_ranges = {}
+        for marker_start, marker_end in [('F_START', 'F_END'), ('P_START', 'P_END')]:
+            self.find_marker_range(marker_start, marker_end)
+
+    def find_marker_range(self, marker_start, marker_end):
+        key = (marker_start, marker_end)
+        if key in self.marker_ranges:
+            return self.marker_ranges[key]
+
+        start_positions = self.lump_index.get(marker_start)
+        if not start_positions:
+            lump_range = (0, 0)
+        else:
+            start = start_positions[0] + 1
+            end = len(self.lumps)
+            for i in self.lump_index.get(marker_end, []):
+                if i >= start:
+                    end = i
+                    break
+
+            lump_range = (start, end)
+
+        self.marker_ranges[key] = lump_range
+        return lump_range
 
     def get_lump(self, lump_name):
-        for lump in self.lumps:
-            if lump.name == lump_name:
-                return lump
+        self.stats.count('lump_lookups')
+        positions = self.lump_index.get(lump_name)
+        if not positions:
+            return None
 
-        return None
+        return self.lumps[positions[0]]
 
     def get_all_lumps(self, lump_name):
-        lumps = []
-        for lump in self.lumps:
-            if lump.name == lump_name:
-                lumps.append(lump)
-
-        return lumps
+        self.stats.count('lump_lookups')
+        return [self.lumps[i] for i in self.lump_index.get(lump_name, [])]
 
     def read_lump_data(self, lump):
+        self.stats.count('bytes_read', lump.size)
+        if self.view is not None:
+            return self.view[lump.offset:lump.offset + lump.size]
+
         self.fd.seek(lump.offset)
         return self.fd.read(lump.size)
 
+    def lump_digest(self, lump):
+        key = (lump.offset, lump.size)
+        if key not in self.lump_digests:
+            data = self.read_lump_data(lump)
+            self.lump_digests[key] = hashlib.blake2b(data, digest_size=16).digest()
+
+        return self.lump_digests[key]
+
     def read_lump(self, lump_name):
         lump = self.get_lump(lump_name)
         if not lump:
@@ -65,59 +552,32 @@ class Wad(object):
 
         return self.read_lump_data(lump)
 
+    @phase('find_umapinfo_textures')
     def find_umapinfo_textures(self):
         textures = set()
 
         umapinfo = self.read_lump('UMAPINFO')
         if umapinfo:
-            print('Loading umapinfo textures')
-            umapinfo = umapinfo.decode('ascii', errors='ignore')
+            umapinfo = bytes(umapinfo).decode('ascii', errors='ignore')
             for line in umapinfo.split('\n'):
                 if line.lstrip().lower().startswith('skytexture'):
                     try:
                         texture = line.split('"')[1::2][0]
                         textures.add(texture)
                     except:
-                        print('Badly formatted umapinfo line: {}'.format(line))
+                        print('Badly formatted umapinfo line: {}'.format(line), file=sys.stderr)
 
         return list(textures)
 
     def load_textures(self):
         return self.load_texture_lump('TEXTURE1')
 
+    @phase('load_textures')
     def load_texture_lump(self, lump_name):
-        print('Loading textures')
-
-        lump = self.read_lump(lump_name)
-        textures = []
-
-        texture_offsets = []
-        num_textures = struct.unpack('<I', lump[0:4])[0]
-
-        offset = 4
-        for i in range(num_textures):
-            texture_offset = struct.unpack('<I', lump[offset:offset + 4])[0]
-            texture_offsets.append(texture_offset)
-            offset += 4
-
-        for i in range(num_textures):
-            offset = texture_offsets[i]
-            name, masked, width, height, columndir, num_patches = struct.unpack('<8sIHHIH', lump[offset:offset + 22])
-            offset += 22
-
-            map_patches = []
-            for j in range(num_patches):
-                x, y, patch_index, stepdir, colormap = struct.unpack('<HHHHH', lump[offset :offset + 10])
-                map_patches.append(MapPatch(self.patches[patch_index], x, y, stepdir, colormap))
-                offset += 10
-
-            textures.append(Texture(sanitize_lump_name(name), masked, width, height, columndir, map_patches))
-
-        return textures
+        return TextureTable.from_lump(self.patches, self.read_lump(lump_name))
 
+    @phase('load_patches')
     def load_patches(self):
-        print('Loading patches')
-
         lump = self.read_lump('PNAMES')
         patches = []
 
@@ -131,9 +591,8 @@ class Wad(object):
 
         return patches
 
+    @phase('load_flats')
     def load_flats(self):
-        print('Loading flats')
-
         flats = []
         for lump in self.lumps_between_markers('F_START', 'F_END'):
             flats.append(lump.name)
@@ -193,42 +652,23 @@ class Wad(object):
 
         return table
 
-    def load_animated_lump(self, flats, textures):
+    def load_animated_lump(self, flats, texture_names):
         anim_flats = []
         anim_textures = []
 
+        flat_positions = first_positions(flats)
+        texture_positions = first_positions(texture_names)
+
         for kind, name_last, name_first in self.load_animdefs():
             if kind == 0:
-                do_append = False
-                lump_names = []
-                for flat in flats:
-                    if flat == name_first:
-                        do_append = True
-                    if do_append:
-                        lump_names.append(flat)
-                    if flat == name_last:
-                        break
-
-                anim_flats.append(lump_names)
+                anim_flats.append(animation_range(flats, flat_positions, name_first, name_last))
 
             elif kind == 1:
-                do_append = False
-                lump_names = []
-                for texture in textures:
-                    if texture.name == name_first:
-                        do_append = True
-                    if do_append:
-                        lump_names.append(texture.name)
-                    if texture.name == name_last:
-                        break
-
-                anim_textures.append(lump_names)
+                anim_textures.append(animation_range(texture_names, texture_positions, name_first, name_last))
 
         return (anim_flats, anim_textures)
 
     def load_switches_lump(self):
-        print('Loading switches lump')
-
         # From p_switch.c
         default_switches = [
             # Doom shareware episode 1 switches
@@ -293,10 +733,9 @@ class Wad(object):
 
         return anim_textures
 
-    def load_animations(self, flats, textures):
-        print('Loading animations')
-
-        anim_flats, anim_textures = self.load_animated_lump(flats, textures)
+    @phase('load_animations')
+    def load_animations(self, flats, texture_names):
+        anim_flats, anim_textures = self.load_animated_lump(flats, texture_names)
 
         #
         # Switches can be animated. In this case the base on/off textures are
@@ -307,12 +746,12 @@ class Wad(object):
         switches = []
         switch_anim_base = self.load_switches_lump()
 
-        print('Finding animated switch textures')
+        anim_index = build_animation_index(anim_textures)
         for texture_on, texture_off in switch_anim_base:
             switch_anim = [texture_off, texture_on]
-            for animation in anim_textures:
-                if texture_on in animation or texture_off in animation:
-                    switch_anim.extend(animation)
+            groups = set(anim_index.get(texture_on, [])) | set(anim_index.get(texture_off, []))
+            for group in sorted(groups):
+                switch_anim.extend(anim_textures[group])
 
             switches.append(switch_anim)
 
@@ -321,160 +760,214 @@ class Wad(object):
         return (anim_flats, anim_textures)
 
     def lumps_between_markers(self, marker_start, marker_end):
-        in_range = False
-        lumps = []
+        start, end = self.find_marker_range(marker_start, marker_end)
+        return self.lumps[start:end]
 
-        for lump in self.lumps:
-            if in_range:
-                if lump.name == marker_end:
-                    break
+    def scan_map_lump(self, lump, scan):
+        #
+        # Returns the scan() result for a map lump. Results are kept for the
+        # rest of the run, and with a manifest loaded lumps whose digest is
+        # already in map_scans are not scanned again.
+        #
+        key = (lump.name, lump.offset, lump.size)
+        if key in self.scan_results:
+            return self.scan_results[key]
+
+        if self.map_scans is None:
+            self.stats.count('lumps_scanned')
+            result = scan(self.read_lump_data(lump))
+        else:
+            digest_key = '{}:{}'.format(lump.name, self.lump_digest(lump).hex())
+            if digest_key in self.map_scans:
+                self.stats.count('lumps_reused')
+            else:
+                self.stats.count('lumps_scanned')
+                self.map_scans[digest_key] = scan(self.read_lump_data(lump))
 
-                lumps.append(lump)
+            result = self.map_scans[digest_key]
 
-            elif lump.name == marker_start:
-                in_range = True
+        self.scan_results[key] = result
+        return result
 
-        return lumps
+    def scan_map_lumps(self, lump_name, scan, kind):
+        # Returns the union of the kind names over every lump_name lump
+        names = set()
+        for lump in self.get_all_lumps(lump_name):
+            names.update(self.scan_map_lump(lump, scan).get(kind, []))
 
-    def texture_add(self, textures, name):
-        name = sanitize_lump_name(name)
-        if name != '-':
-            textures.add(name)
+        return names
 
+    @phase('find_used_textures')
     def find_used_textures(self):
-        print('Finding used textures')
-
-        textures = set()
-
-        for lump in self.get_all_lumps('SIDEDEFS'):
-            lump = self.read_lump_data(lump)
-            for offset in range(0, len(lump), 30):
-                _, _, tex_upper, tex_mid, tex_lower, _ = struct.unpack('<HH8s8s8sH', lump[offset:offset + 30])
-                self.texture_add(textures, tex_upper)
-                self.texture_add(textures, tex_mid)
-                self.texture_add(textures, tex_lower)
+        textures = self.scan_map_lumps('SIDEDEFS', scan_sidedefs, 'textures')
+        textures.update(self.scan_map_lumps('TEXTMAP', scan_textmap, 'textures'))
 
         # Sky textures are special
         textures.update(['SKY1', 'SKY2', 'SKY3'])
 
         return list(textures)
 
+    @phase('find_used_flats')
     def find_used_flats(self):
-        flats = set()
-        for lump in self.get_all_lumps('SECTORS'):
-            lump = self.read_lump_data(lump)
-            for offset in range(0, len(lump), 26):
-                _, _, flat_floor, flat_ceiling, _, _, _ = struct.unpack('<HH8s8sHHH', lump[offset:offset + 26])
-                flats.add(sanitize_lump_name(flat_floor))
-                flats.add(sanitize_lump_name(flat_ceiling))
+        if self.cached_used_flats is not None:
+            return list(self.cached_used_flats)
+
+        flats = self.scan_map_lumps('SECTORS', scan_sectors, 'flats')
+        flats.update(self.scan_map_lumps('TEXTMAP', scan_textmap, 'flats'))
 
         return list(flats)
 
+    @phase('load_manifest')
+    def load_manifest(self, filename):
+        self.map_scans = {}
+
+        try:
+            with open(filename, 'r') as fd:
+                manifest = json.load(fd)
+        except (OSError, ValueError):
+            return
+
+        if manifest.get('version') == MANIFEST_VERSION:
+            self.map_scans = manifest['scans']
+
+    @phase('save_manifest')
+    def save_manifest(self, filename):
+        #
+        # Record the scan results for the map lumps in the wad, keyed on
+        # their digests. Results for lumps which are no longer in the wad
+        # are dropped.
+        #
+        scans = {}
+        for lump in self.lumps:
+            if lump.name not in ('SIDEDEFS', 'SECTORS', 'TEXTMAP'):
+                continue
+
+            key = '{}:{}'.format(lump.name, self.lump_digest(lump).hex())
+            if key in self.map_scans:
+                scans[key] = self.map_scans[key]
+
+        manifest = OrderedDict([('version', MANIFEST_VERSION), ('scans', scans)])
+
+        tmp_file = '{}.{}.tmp'.format(filename, os.getpid())
+        with open(tmp_file, 'w') as fd:
+            json.dump(manifest, fd)
+        os.replace(tmp_file, filename)
+
 class UsedTextureSet(object):
-    def __init__(self, iwad, pwad):
+    def __init__(self, iwad, pwad, stats=None):
         self.iwad = iwad
         self.pwad = pwad
+        self.stats = stats if stats is not None else pwad.stats
 
-        self.textures = iwad.textures + pwad.textures
+        self.texture_names = iwad.textures.names + pwad.textures.names
         self.patches = iwad.patches + pwad.patches
         self.flats = iwad.flats + pwad.flats
+        self.texture_index = self.build_texture_index()
 
         self.used_textures = (pwad.find_used_textures() +
                               pwad.find_umapinfo_textures())
 
-        anim_flats, anim_textures = pwad.load_animations(self.flats, self.textures)
+        anim_flats, anim_textures = pwad.load_animations(self.flats, self.texture_names)
         self.used_textures = self.mark_used_animations(self.used_textures, anim_textures)
 
         self.used_patches = self.find_used_patches()
+        self.index_used_patches()
 
         self.used_flats = iwad.find_used_flats() + pwad.find_used_flats()
         self.used_flats = self.mark_used_animations(self.used_flats, anim_flats)
 
-    def get_texture_entry(self, texture_name):
+    def build_texture_index(self):
         #
         # The TEXTUREx lump may have duplicates. The pwad has precedence over
-        # the iwad, but we take the first valid entry from either wad.
+        # the iwad, but we take the first valid entry from either wad. Entries
+        # are (table, index) references into the wads' texture tables.
         #
-        pwad_entries = [t for t in self.pwad.textures if t.name == texture_name]
-        if len(pwad_entries) > 0:
-            return pwad_entries[0]
-
-        iwad_entries = [t for t in self.iwad.textures if t.name == texture_name]
-        if len(iwad_entries) > 0:
-            return iwad_entries[0]
+        index = {}
+        for table in [self.pwad.textures, self.iwad.textures]:
+            for i, name in enumerate(table.names):
+                index.setdefault(name, (table, i))
 
-        return None
+        return index
 
+    @phase('find_used_patches')
     def find_used_patches(self):
-        print('Finding used patches')
-
         patches = set()
+        self.stats.count('texture_lookups', len(self.used_textures))
         for texture_name in self.used_textures:
             # Textures like colormaps may not have an entry and can be skipped.
-            texture = self.get_texture_entry(texture_name)
-            if texture is not None:
-                for map_patch in texture.patches:
-                    patches.add(map_patch.name)
+            entry = self.texture_index.get(texture_name)
+            if entry is not None:
+                table, i = entry
+                patches.update(table.patch_names(i))
 
         return list(patches)
 
+    @phase('mark_used_animations')
     def mark_used_animations(self, textures, animations):
-        print('Marking used animations')
-
-        new_textures = set(textures)
+        anim_index = build_animation_index(animations)
+        self.stats.count('animation_lookups', len(textures))
 
+        groups = set()
         for texture in textures:
-            for animation in animations:
-                if texture in animation:
-                    new_textures.update(animation)
+            groups.update(anim_index.get(texture, []))
+
+        new_textures = set(textures)
+        for group in groups:
+            new_textures.update(animations[group])
 
         return list(new_textures)
 
-    def get_used_patch_index(self, name):
+    def index_used_patches(self):
+        self.used_patch_index = {}
         for i, patch in enumerate(self.used_patches):
-            if patch == name:
-                return i
+            self.used_patch_index.setdefault(patch, i)
 
-        return -1
+    def get_used_patch_index(self, name):
+        return self.used_patch_index.get(name, -1)
 
-    def removable_lumps(self):
-        unused_patches = []
-        for patch in self.patches:
-            if patch not in self.used_patches and patch not in self.used_flats:
-                unused_patches.append(patch)
+    def unused_patches(self):
+        used = set(self.used_patches) | set(self.used_flats)
+        return [patch for patch in self.patches if patch not in used]
 
-        unused_flats = []
-        for flat in self.flats:
-            if flat not in self.used_flats and flat not in self.used_patches:
-                unused_flats.append(flat)
+    def unused_flats(self):
+        used = set(self.used_patches) | set(self.used_flats)
+        return [flat for flat in self.flats if flat not in used]
 
-        return unused_patches + unused_flats
+    def removable_lumps(self):
+        return self.unused_patches() + self.unused_flats()
 
+    @phase('build_pnames_lump')
     def build_pnames_lump(self):
         # The iwad pnames are always included first
-        iwad_patches = self.iwad.load_patches()
-        pwad_patches = [p for p in self.used_patches if p not in iwad_patches]
+        iwad_patches = list(self.iwad.patches)
+        iwad_patch_set = set(iwad_patches)
+        pwad_patches = [p for p in self.used_patches if p not in iwad_patch_set]
         self.used_patches = iwad_patches + pwad_patches
+        self.index_used_patches()
 
-        lump = struct.pack('<I', len(self.used_patches))
-        for patch in self.used_patches:
-            lump += struct.pack('<8s', patch.encode())
+        lump = bytearray(4 + (8 * len(self.used_patches)))
+        struct.pack_into('<I', lump, 0, len(self.used_patches))
+        for i, patch in enumerate(self.used_patches):
+            struct.pack_into('<8s', lump, 4 + (8 * i), patch.encode())
 
         return lump
 
+    @phase('build_textures_lump')
     def build_textures_lump(self):
-        print('Building textures lump')
+        used_textures = set(self.used_textures)
+        iwad_table = self.iwad.textures
+        pwad_table = self.pwad.textures
 
         # The iwad textures are always included first
-        textures = self.iwad.load_textures()
+        textures = [(iwad_table, i) for i in range(len(iwad_table))]
 
         # The pwad may change the patches for an iwad texture
         # Only update entries which are used in the pwad
-        for i, texture in enumerate(textures):
-            if texture.name in self.used_textures:
-                entry = self.get_texture_entry(texture.name)
+        for n, name in enumerate(iwad_table.names):
+            if name in used_textures:
+                entry = self.texture_index.get(name)
                 if entry:
-                    textures[i] = entry
+                    textures[n] = entry
 
         #
         # Python sets (used to build self.used_textures) are unordered.
@@ -482,51 +975,56 @@ class UsedTextureSet(object):
         # just with unused textures removed. Animated textures will break
         # if their ordering is incorrect.
         #
-        visited = []
-        for entry in self.pwad.textures:
-            if entry in textures:
+        included = set(table.key(i) for table, i in textures)
+        visited = set()
+        for i, name in enumerate(pwad_table.names):
+            if name not in used_textures:
                 continue
-            if entry.name not in self.used_textures:
+            if name in visited:
                 continue
-            if entry.name in visited:
+            if pwad_table.key(i) in included:
                 continue
 
-            textures.append(entry)
-            visited.append(entry.name)
+            textures.append((pwad_table, i))
+            visited.add(name)
 
         #
-        # Build the TEXTUREx lump
+        # Build the TEXTUREx lump. Patch indices are remapped from each
+        # table's PNAMES to the rebuilt PNAMES.
         #
-        lump = struct.pack('<I', len(textures))
+        patch_maps = {}
+        for table in [iwad_table, pwad_table]:
+            patch_maps[id(table)] = [self.get_used_patch_index(name) for name in table.pnames]
 
-        offset_table = []
-        offset = 4 + (4 * len(textures))
+        size = 4 + (4 * len(textures))
+        for table, i in textures:
+            size += 22 + (10 * len(table.patch_rows(i)))
 
-        data = b''
-        for texture in textures:
-            offset_table.append(offset)
+        lump = bytearray(size)
+        struct.pack_into('<I', lump, 0, len(textures))
 
-            data += struct.pack('<8sIHHIH', texture.name.encode(), texture.masked, texture.width, texture.height, texture.columndir, len(texture.patches))
+        offset = 4 + (4 * len(textures))
+        for n, (table, i) in enumerate(textures):
+            struct.pack_into('<I', lump, 4 + (4 * n), offset)
+
+            rows = table.patch_rows(i)
+            struct.pack_into('<8sIHHIH', lump, offset, table.names[i].encode(), table.masked[i], table.width[i], table.height[i], table.columndir[i], len(rows))
+            offset += 22
 
-            for map_patch in texture.patches:
-                patch_index = self.get_used_patch_index(map_patch.name)
+            patch_map = patch_maps[id(table)]
+            for j in rows:
+                patch_index = patch_map[table.patch_index[j]]
                 if patch_index == -1:
-                    print('Bad patch {} for texture {}'.format(map_patch.name, texture.name))
+                    print('Bad patch {} for texture {}'.format(table.pnames[table.patch_index[j]], table.names[i]), file=sys.stderr)
                     sys.exit(1)
 
-                data += struct.pack('<HHHHH', map_patch.x, map_patch.y, patch_index, map_patch.stepdir, map_patch.colormap)
-
-            offset += 22 + (10 * len(texture.patches))
-
-        for offset in offset_table:
-            lump += struct.pack('<I', offset)
+                struct.pack_into('<HHHHH', lump, offset, table.patch_x[j], table.patch_y[j], patch_index, table.patch_stepdir[j], table.patch_colormap[j])
+                offset += 10
 
-        lump += data
         return lump
 
+    @phase('build_animated_lump')
     def build_animated_lump(self):
-        print('Building animated lump')
-
         orig_lump = self.pwad.read_lump('ANIMATED')
 
         lump = b''
@@ -547,9 +1045,8 @@ class UsedTextureSet(object):
 
         return lump + b'\xff'
 
+    @phase('build_switches_lump')
     def build_switches_lump(self):
-        print('Building switches lump')
-
         orig_lump = self.pwad.read_lump('SWITCHES')
 
         lump = b''
@@ -567,74 +1064,431 @@ class UsedTextureSet(object):
         return lump + (b'\x00' * 20)
 
 class WadWriter(object):
-    def __init__(self, iwad, pwad, used):
+    def __init__(self, iwad, pwad, used, stats=None):
         self.iwad = iwad
         self.pwad = pwad
         self.used = used
+        self.stats = stats if stats is not None else used.stats
 
-    def identical_lump_in_iwad(self, lump_name):
-        iwad_lump = self.iwad.read_lump(lump_name)
-        pwad_lump = self.pwad.read_lump(lump_name)
-
-        if iwad_lump is None or pwad_lump is None:
+    def identical_lump_in_iwad(self, lump):
+        self.stats.count('digest_lookups')
+        iwad_lump = self.iwad.get_lump(lump.name)
+        if iwad_lump is None:
             return False
 
         # Don't remove markers
-        if len(iwad_lump) == 0:
+        if iwad_lump.size == 0:
             return False
 
-        return iwad_lump == pwad_lump
+        #
+        # Only lumps with matching sizes need to be read. The digests are
+        # cached, so each iwad lump is hashed at most once.
+        #
+        if iwad_lump.size != lump.size:
+            return False
 
-    def write(self, filename):
-        fd = open(filename, 'wb')
+        return self.iwad.lump_digest(iwad_lump) == self.pwad.lump_digest(lump)
 
-        removable = self.used.removable_lumps()
+    def build_lumps(self, lumps):
+        #
+        # Rebuild the small index lumps up front so that every lump size is
+        # known before anything is written. PNAMES must be built before
+        # TEXTUREx.
+        #
+        builders = [
+            ('PNAMES', self.used.build_pnames_lump),
+            ('TEXTURE1', self.used.build_textures_lump),
+            ('ANIMATED', self.used.build_animated_lump),
+            ('SWITCHES', self.used.build_switches_lump),
+            ]
+
+        names = set(lump.name for lump in lumps)
+
+        blobs = {}
+        for lump_name, build in builders:
+            if lump_name == 'PNAMES' or lump_name in names:
+                blobs[lump_name] = build()
+
+        return blobs
+
+    def copy_lump(self, fd, offset, lump):
+        #
+        # Copy an unchanged lump straight from the pwad file, letting the
+        # kernel move the data where possible.
+        #
+        src = self.pwad.fd.fileno()
+        dst = fd.fileno()
+        src_offset = lump.offset
+        remaining = lump.size
+
+        try:
+            while remaining > 0:
+                if hasattr(os, 'copy_file_range'):
+                    copied = os.copy_file_range(src, dst, remaining, src_offset, offset)
+                elif hasattr(os, 'sendfile'):
+                    os.lseek(dst, offset, os.SEEK_SET)
+                    copied = os.sendfile(dst, src, src_offset, remaining)
+                else:
+                    # Neither is available, e.g. on Windows
+                    break
+
+                if copied == 0:
+                    break
+
+                src_offset += copied
+                offset += copied
+                remaining -= copied
+
+        except OSError:
+            pass
+
+        if remaining > 0:
+            fd.seek(offset)
+            fd.write(self.pwad.read_lump_data(Lump(lump.name, src_offset, remaining)))
+            fd.flush()
+
+    def select_lumps(self, check_iwad=True):
+        removable = set(self.used.removable_lumps())
 
         lumps = []
-        for lump in pwad.lumps:
+        for lump in self.pwad.lumps:
             if lump.name.startswith('_') or lump.name.startswith('\\'):
                 continue
             if lump.name in removable:
                 continue
-            if self.identical_lump_in_iwad(lump.name):
+            if check_iwad and self.identical_lump_in_iwad(lump):
                 continue
 
             lumps.append(lump)
 
-        fd.write(struct.pack('<4sII', b'PWAD', len(lumps), 12))
+        return lumps
 
-        # PNAMES must be built before TEXTUREx, but keep the original lump order
-        pnames_blob = self.used.build_pnames_lump()
+    @phase('report')
+    def report(self):
+        #
+        # Describe what write() would remove without writing anything. Only
+        # the directory and the lumps needed for analysis are read, so lumps
+        # matching an iwad lump by name and size are reported as candidates
+        # rather than confirmed by comparing their contents.
+        #
+        lumps = self.select_lumps(check_iwad=False)
+        kept = set(lumps)
 
-        lump_blobs = []
-        for lump in lumps:
-            if lump.name == 'PNAMES':
-                blob = pnames_blob
-            elif lump.name == 'TEXTURE1':
-                blob = self.used.build_textures_lump()
-            elif lump.name == 'ANIMATED':
-                blob = self.used.build_animated_lump()
-            elif lump.name == 'SWITCHES':
-                blob = self.used.build_switches_lump()
+        # Rebuilding PNAMES changes the used patches, so check those first
+        unused_patches = set(self.used.unused_patches())
+        unused_flats = set(self.used.unused_flats())
+
+        blobs = self.build_lumps(lumps)
+
+        removed_patches = []
+        removed_flats = []
+        removed_other = []
+        for lump in self.pwad.lumps:
+            if lump in kept:
+                continue
+
+            entry = OrderedDict([('name', lump.name), ('size', lump.size)])
+            if lump.name in unused_patches:
+                removed_patches.append(entry)
+            elif lump.name in unused_flats:
+                removed_flats.append(entry)
             else:
-                blob = pwad.read_lump_data(lump)
+                removed_other.append(entry)
+
+        iwad_candidates = []
+        for lump in lumps:
+            if lump.name in blobs:
+                continue
+
+            iwad_lump = self.iwad.get_lump(lump.name)
+            if iwad_lump is not None and iwad_lump.size != 0 and iwad_lump.size == lump.size:
+                iwad_candidates.append(OrderedDict([('name', lump.name), ('size', lump.size)]))
+
+        used_textures = set(self.used.used_textures)
+        removed_textures = sorted(set(name for name in self.pwad.textures.names if name not in used_textures))
 
-            lump_blobs.append((lump.name, blob))
+        rebuilt = OrderedDict()
+        for lump_name, blob in blobs.items():
+            lump = self.pwad.get_lump(lump_name)
+            if lump is not None:
+                rebuilt[lump_name] = OrderedDict([('size', lump.size), ('new_size', len(blob))])
 
-        offset = 12 + (16 * len(lump_blobs))
-        for lump_name, lump_data in lump_blobs:
-            fd.write(struct.pack('<II8s', offset, len(lump_data), lump_name.encode()))
-            offset += len(lump_data)
+        original_size = os.path.getsize(self.pwad.filename)
+        output_size = 12 + (16 * len(lumps))
+        for lump in lumps:
+            output_size += len(blobs[lump.name]) if lump.name in blobs else lump.size
+
+        return OrderedDict([
+            ('iwad', self.iwad.filename),
+            ('pwad', self.pwad.filename),
+            ('removed_patches', removed_patches),
+            ('removed_flats', removed_flats),
+            ('removed_other', removed_other),
+            ('removed_textures', removed_textures),
+            ('rebuilt_lumps', rebuilt),
+            ('iwad_identical_candidates', iwad_candidates),
+            ('original_size', original_size),
+            ('output_size', output_size),
+            ('bytes_saved', original_size - output_size),
+            ('candidate_bytes', sum(entry['size'] for entry in iwad_candidates)),
+            ])
+
+    @phase('write')
+    def write(self, filename, dedupe=False):
+        #
+        # With dedupe, lumps whose contents match an earlier lump are not
+        # written again and their directory entry points at the first copy.
+        #
+        lumps = self.select_lumps()
+        blobs = self.build_lumps(lumps)
+
+        # Lay out the directory: (lump, size, offset, whether to write data)
+        entries = []
+        first_offsets = {}
+        offset = 12 + (16 * len(lumps))
+        for lump in lumps:
+            size = len(blobs[lump.name]) if lump.name in blobs else lump.size
+
+            if dedupe and size > 0:
+                if lump.name in blobs:
+                    key = (size, hashlib.blake2b(blobs[lump.name], digest_size=16).digest())
+                else:
+                    key = (size, self.pwad.lump_digest(lump))
+
+                if key in first_offsets:
+                    self.stats.count('lumps_deduplicated')
+                    entries.append((lump, size, first_offsets[key], False))
+                    continue
+
+                first_offsets[key] = offset
+
+            entries.append((lump, size, offset, True))
+            offset += size
+
+        # Write the header and directory, then stream the lump data after it
+        fd = open(filename, 'wb')
+        fd.write(struct.pack('<4sII', b'PWAD', len(lumps), 12))
 
-        for _, lump_data in lump_blobs:
-            fd.write(lump_data)
+        for lump, size, offset, _ in entries:
+            fd.write(struct.pack('<II8s', offset, size, lump.name.encode()))
+
+        offset = 12 + (16 * len(lumps))
+        for lump, size, _, emit in entries:
+            if not emit:
+                continue
+
+            if lump.name in blobs:
+                fd.write(blobs[lump.name])
+            else:
+                fd.flush()
+                self.copy_lump(fd, offset, lump)
+                fd.seek(offset + size)
+
+            offset += size
+            self.stats.count('lumps_written')
+
+        self.stats.count('bytes_written', offset)
 
         fd.close()
 
-if __name__ == '__main__':
-    iwad = Wad(sys.argv[1])
-    pwad = Wad(sys.argv[2])
-    outfile = sys.argv[3]
+def load_wad(filename, cache_dir=None, stats=None):
+    # Open a wad, prefetch the lumps needed for analysis and parse its tables
+    wad = Wad(filename, use_mmap=True, cache_dir=cache_dir, stats=stats)
+    if not wad.from_cache:
+        wad.prefetch(ANALYSIS_LUMPS)
+
+    wad.load_tables()
+    return wad
+
+def strip_wad(iwad, pwad, output_filename, manifest=None, dedupe=False):
+    #
+    # With a manifest filename, map lumps scanned by a previous run are
+    # reused and the manifest is updated for the next one.
+    #
+    if manifest is not None:
+        pwad.load_manifest(manifest)
 
     writer = WadWriter(iwad, pwad, UsedTextureSet(iwad, pwad))
-    writer.write(outfile)
+    writer.write(output_filename, dedupe)
+
+    if manifest is not None:
+        pwad.save_manifest(manifest)
+
+def strip_pwad(iwad, pwad_filename, output_filename, stats=None, manifest=None, dedupe=False):
+    pwad = load_wad(pwad_filename, stats=stats)
+    try:
+        strip_wad(iwad, pwad, output_filename, manifest, dedupe)
+    finally:
+        pwad.close()
+
+def load_wads(iwad_filename, pwad_filename, cache_dir=None, stats=None):
+    #
+    # Load the iwad and pwad concurrently. Most of the time is spent waiting
+    # on reads, which overlap on the two threads.
+    #
+    with ThreadPoolExecutor(2) as executor:
+        iwad = executor.submit(load_wad, iwad_filename, cache_dir, stats)
+        pwad = executor.submit(load_wad, pwad_filename, None, stats)
+
+        return iwad.result(), pwad.result()
+
+def report_pwad(iwad, pwad_filename, stats=None):
+    pwad = load_wad(pwad_filename, stats=stats)
+    try:
+        writer = WadWriter(iwad, pwad, UsedTextureSet(iwad, pwad))
+        return writer.report()
+    finally:
+        pwad.close()
+
+def find_pwads(paths):
+    pwad_filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            for filename in sorted(os.listdir(path)):
+                if filename.lower().endswith('.wad'):
+                    pwad_filenames.append(os.path.join(path, filename))
+        else:
+            pwad_filenames.append(path)
+
+    return pwad_filenames
+
+# The iwad shared by batch worker processes
+batch_iwad = None
+
+def init_batch_worker(iwad, iwad_filename, cache_dir):
+    global batch_iwad
+
+    # Workers which weren't forked from the parent parse the iwad themselves
+    if iwad is None:
+        iwad = Wad(iwad_filename, use_mmap=True, cache_dir=cache_dir)
+
+    batch_iwad = iwad
+
+def batch_strip_pwad(job):
+    pwad_filename, output_filename, manifest, dedupe = job
+
+    # Count this pwad's reads of the shared iwad in its own stats
+    stats = Stats()
+    batch_iwad.stats = stats
+
+    if os.path.abspath(pwad_filename) == os.path.abspath(output_filename):
+        return (pwad_filename, False, 'Output would overwrite the input', stats.to_dict())
+
+    # Write to a temporary file so that a failure leaves any previous output in place
+    tmp_filename = '{}.{}.tmp'.format(output_filename, os.getpid())
+    try:
+        strip_pwad(batch_iwad, pwad_filename, tmp_filename, stats, manifest, dedupe)
+        os.replace(tmp_filename, output_filename)
+    except (Exception, SystemExit) as e:
+        if os.path.exists(tmp_filename):
+            os.remove(tmp_filename)
+
+        return (pwad_filename, False, '{}: {}'.format(type(e).__name__, e), stats.to_dict())
+
+    return (pwad_filename, True, output_filename, stats.to_dict())
+
+def strip_batch(iwad_filename, pwad_filenames, output_dir, jobs=None, cache_dir=None, incremental=False,
+                dedupe=False):
+    #
+    # Strip each pwad against the same iwad on a process pool. Where fork is
+    # available the workers inherit the iwad parsed here, otherwise each
+    # worker parses it once (from the cache, if one is given). Returns a
+    # list of (pwad filename, success, output filename or error, stats)
+    # tuples.
+    #
+    jobs_list = []
+    outputs = set()
+    for pwad_filename in pwad_filenames:
+        output_filename = os.path.join(output_dir, os.path.basename(pwad_filename))
+        if output_filename in outputs:
+            raise ValueError('Multiple pwads would be written to {}'.format(output_filename))
+
+        outputs.add(output_filename)
+        manifest = output_filename + '.manifest' if incremental else None
+        jobs_list.append((pwad_filename, output_filename, manifest, dedupe))
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    if 'fork' in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context('fork')
+        iwad = Wad(iwad_filename, use_mmap=True, cache_dir=cache_dir)
+
+        # Parse the lazily loaded tables before forking so workers share them
+        iwad.load_tables()
+    else:
+        context = multiprocessing.get_context()
+        iwad = None
+
+    with context.Pool(jobs, init_batch_worker, (iwad, iwad_filename, cache_dir)) as pool:
+        return pool.map(batch_strip_pwad, jobs_list, chunksize=1)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Remove unused textures, patches and flats from a wad')
+    parser.add_argument('iwad')
+    parser.add_argument('files', nargs='+', metavar='file',
+                        help='<pwad.wad> <output.wad>, or with --batch/--report the pwads and directories of pwads')
+    parser.add_argument('--batch', metavar='OUTPUT_DIR', help='Strip many pwads in parallel, writing them to OUTPUT_DIR')
+    parser.add_argument('-j', '--jobs', type=int, help='Number of worker processes for --batch')
+    parser.add_argument('--dedupe', action='store_true',
+                        help='Store identical lumps once, with their directory entries sharing an offset')
+    parser.add_argument('--report', action='store_true',
+                        help='Report reclaimable space as JSON lines instead of writing wads')
+    parser.add_argument('--cache-dir', help='Directory for caching the parsed iwad between runs')
+    parser.add_argument('--stats', action='store_true', help='Print per-phase timings and counters as JSON')
+    parser.add_argument('--incremental', action='store_true',
+                        help='Keep a <output>.manifest of map lump scans and only rescan changed map lumps')
+    args = parser.parse_args()
+
+    if args.report:
+        iwad = Wad(args.iwad, use_mmap=True, cache_dir=args.cache_dir)
+
+        failed = 0
+        for pwad_filename in find_pwads(args.files):
+            stats = Stats()
+            iwad.stats = stats
+            try:
+                report = report_pwad(iwad, pwad_filename, stats)
+            except (Exception, SystemExit) as e:
+                report = OrderedDict([('pwad', pwad_filename), ('error', '{}: {}'.format(type(e).__name__, e))])
+                failed += 1
+
+            if args.stats:
+                report['stats'] = stats.to_dict()
+
+            print(json.dumps(report))
+
+        sys.exit(1 if failed else 0)
+
+    if args.batch:
+        try:
+            results = strip_batch(args.iwad, find_pwads(args.files), args.batch, args.jobs, args.cache_dir,
+                                  args.incremental, args.dedupe)
+        except ValueError as e:
+            parser.error(str(e))
+
+        failed = len([result for result in results if not result[1]])
+
+        if args.stats:
+            print(json.dumps([OrderedDict([('pwad', pwad_filename), ('ok', ok), ('detail', detail), ('stats', stats)])
+                              for pwad_filename, ok, detail, stats in results], indent=2))
+        else:
+            for pwad_filename, ok, detail, _ in results:
+                if ok:
+                    print('OK {} -> {}'.format(pwad_filename, detail))
+                else:
+                    print('FAILED {}: {}'.format(pwad_filename, detail))
+
+            print('{} of {} wads stripped'.format(len(results) - failed, len(results)))
+
+        sys.exit(1 if failed else 0)
+
+    if len(args.files) != 2:
+        parser.error('expected <iwad.wad> <pwad.wad> <output.wad>')
+
+    stats = Stats()
+    iwad, pwad = load_wads(args.iwad, args.files[0], args.cache_dir, stats)
+    manifest = args.files[1] + '.manifest' if args.incremental else None
+    strip_wad(iwad, pwad, args.files[1], manifest, args.dedupe)
+
+    if args.stats:
+        print(json.dumps(stats.to_dict(), indent=2))
@@ -0,0 +1,195 @@
+#
+# Script to generate a synthetic iwad/pwad pair for exercising wad_strip.py.
+# The same seed and parameters always produce byte-identical wads.
+#
+#   python3 wad_synth.py <iwad.wad> <pwad.wad> [--maps N] [--sidedefs N] ...
+#
+# The pwad uses a fraction of its own textures and flats, re-ships some
+# iwad patches unchanged and has ANIMATED and SWITCHES lumps, so every
+# stage of wad_strip has work to do.
+#
+from collections import namedtuple
+import argparse
+import random
+import struct
+
+SynthParams = namedtuple('SynthParams', 'maps sidedefs sectors textures patches flats animations switches seed',
+                         defaults=(4, 2000, 400, 1000, 800, 200, 20, 20, 0))
+
+# Frames per ANIMATED entry
+ANIM_FRAMES = 4
+
+def lump_name(prefix, i):
+    return '{}{:06d}'.format(prefix, i)
+
+def pack_name(name, size=8):
+    return name.encode().ljust(size, b'\x00')
+
+def build_wad(wad_type, lumps):
+    directory = bytearray()
+    data = bytearray()
+
+    for name, blob in lumps:
+        directory += struct.pack('<II8s', 12 + len(data), len(blob), pack_name(name))
+        data += blob
+
+    return struct.pack('<4sII', wad_type, len(lumps), 12 + len(data)) + data + directory
+
+def build_pnames(patches):
+    return struct.pack('<I', len(patches)) + b''.join(pack_name(p) for p in patches)
+
+def build_texture1(textures):
+    header = bytearray(struct.pack('<I', len(textures)))
+    body = bytearray()
+
+    offset = 4 + (4 * len(textures))
+    for name, patch_indices in textures:
+        header += struct.pack('<I', offset + len(body))
+        body += struct.pack('<8sIHHIH', pack_name(name), 0, 64, 128, 0, len(patch_indices))
+        for i, patch_index in enumerate(patch_indices):
+            body += struct.pack('<HHHHH', 16 * i, 0, patch_index, 1, 0)
+
+    return bytes(header + body)
+
+def build_animated(entries):
+    lump = b''
+    for kind, name_last, name_first in entries:
+        lump += struct.pack('<B9s9sI', kind, pack_name(name_last, 9), pack_name(name_first, 9), 8)
+
+    return lump + b'\xff'
+
+def build_switches(entries):
+    lump = b''
+    for name_off, name_on in entries:
+        lump += struct.pack('<9s9sH', pack_name(name_off, 9), pack_name(name_on, 9), 2)
+
+    return lump + (b'\x00' * 20)
+
+def build_map(rng, index, textures, flats, num_sidedefs, num_sectors):
+    sidedefs = bytearray()
+    for _ in range(num_sidedefs):
+        upper, lower = rng.choice(textures), rng.choice(textures)
+        middle = rng.choice(textures) if rng.random() < 0.2 else '-'
+        sidedefs += struct.pack('<HH8s8s8sH', 0, 0, pack_name(upper), pack_name(middle), pack_name(lower), 0)
+
+    sectors = bytearray()
+    for _ in range(num_sectors):
+        floor, ceiling = rng.choice(flats), rng.choice(flats)
+        sectors += struct.pack('<HH8s8sHHH', 0, 128, pack_name(floor), pack_name(ceiling), 160, 0, 0)
+
+    return [
+        ('MAP{:02d}'.format(index + 1), b''),
+        ('THINGS', bytes(10 * (num_sectors // 4))),
+        ('SIDEDEFS', bytes(sidedefs)),
+        ('SECTORS', bytes(sectors)),
+        ]
+
+def patch_data(rng):
+    return bytes(rng.getrandbits(8) for _ in range(rng.randint(64, 512)))
+
+def flat_data(rng):
+    return bytes([rng.getrandbits(8)]) * 4096
+
+def generate(params):
+    #
+    # Returns the (iwad, pwad) file contents for the given parameters.
+    #
+    rng = random.Random(params.seed)
+
+    #
+    # Iwad: PNAMES, TEXTURE1, patches, flats and a couple of maps
+    #
+    iwad_patches = [lump_name('IP', i) for i in range(params.patches)]
+    iwad_textures = [lump_name('IT', i) for i in range(params.textures)]
+    iwad_flats = [lump_name('IF', i) for i in range(params.flats)]
+
+    iwad_texture_defs = [(name, [rng.randrange(len(iwad_patches)) for _ in range(rng.randint(1, 3))])
+                         for name in iwad_textures]
+
+    iwad_patch_data = [(name, patch_data(rng)) for name in iwad_patches]
+
+    lumps = [
+        ('PLAYPAL', bytes(rng.getrandbits(8) for _ in range(768))),
+        ('PNAMES', build_pnames(iwad_patches)),
+        ('TEXTURE1', build_texture1(iwad_texture_defs)),
+        ('P_START', b''),
+        ]
+    lumps += iwad_patch_data
+    lumps += [('P_END', b''), ('F_START', b'')]
+    lumps += [(name, flat_data(rng)) for name in iwad_flats]
+    lumps += [('F_END', b'')]
+    for i in range(2):
+        lumps += build_map(rng, i, iwad_textures, iwad_flats, params.sidedefs // 4, params.sectors // 4)
+
+    iwad = build_wad(b'IWAD', lumps)
+
+    #
+    # Pwad: its own patches, textures and flats, with animation and switch
+    # ranges laid out at the start of the texture and flat lists. A tenth
+    # of the iwad patches are re-shipped unchanged.
+    #
+    num_reshipped = params.patches // 10
+    pwad_patches = [lump_name('PP', i) for i in range(params.patches)] + iwad_patches[:num_reshipped]
+    pwad_textures = [lump_name('PT', i) for i in range(params.textures)]
+    pwad_flats = [lump_name('PF', i) for i in range(params.flats)]
+
+    # The pwad also replaces the first few iwad textures
+    pwad_texture_defs = [(name, [rng.randrange(len(pwad_patches)) for _ in range(rng.randint(1, 4))])
+                         for name in pwad_textures + iwad_textures[:5]]
+
+    animated = []
+    for i in range(params.animations):
+        first = i * ANIM_FRAMES
+        if i % 2 == 0 and first + ANIM_FRAMES <= len(pwad_flats):
+            animated.append((0, pwad_flats[first + ANIM_FRAMES - 1], pwad_flats[first]))
+        elif first + ANIM_FRAMES <= len(pwad_textures):
+            animated.append((1, pwad_textures[first + ANIM_FRAMES - 1], pwad_textures[first]))
+
+    switches = []
+    switch_base = params.animations * ANIM_FRAMES
+    for i in range(params.switches):
+        off = switch_base + (2 * i)
+        if off + 1 < len(pwad_textures):
+            switches.append((pwad_textures[off], pwad_textures[off + 1]))
+
+    lumps = [
+        ('PNAMES', build_pnames(pwad_patches)),
+        ('TEXTURE1', build_texture1(pwad_texture_defs)),
+        ('ANIMATED', build_animated(animated)),
+        ('SWITCHES', build_switches(switches)),
+        ('P_START', b''),
+        ]
+    lumps += [(name, patch_data(rng)) for name in pwad_patches[:params.patches]]
+    lumps += iwad_patch_data[:num_reshipped]
+    lumps += [('P_END', b''), ('F_START', b'')]
+    lumps += [(name, flat_data(rng)) for name in pwad_flats]
+    lumps += [('F_END', b'')]
+
+    # The maps use half of the pwad textures and flats plus some iwad ones
+    used_textures = rng.sample(pwad_textures, len(pwad_textures) // 2) + iwad_textures[:10]
+    used_flats = rng.sample(pwad_flats, len(pwad_flats) // 2) + iwad_flats[:5]
+    for i in range(params.maps):
+        lumps += build_map(rng, i, used_textures, used_flats, params.sidedefs, params.sectors)
+
+    pwad = build_wad(b'PWAD', lumps)
+
+    return iwad, pwad
+
+def write_pair(iwad_filename, pwad_filename, params):
+    iwad, pwad = generate(params)
+
+    with open(iwad_filename, 'wb') as fd:
+        fd.write(iwad)
+    with open(pwad_filename, 'wb') as fd:
+        fd.write(pwad)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate a synthetic iwad/pwad pair')
+    parser.add_argument('iwad')
+    parser.add_argument('pwad')
+    for field, default in SynthParams._field_defaults.items():
+        parser.add_argument('--{}'.format(field), type=int, default=default)
+    args = parser.parse_args()
+
+    params = SynthParams(**{field: getattr(args, field) for field in SynthParams._fields})
+    write_pair(args.iwad, args.pwad, params)